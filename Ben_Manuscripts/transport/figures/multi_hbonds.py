@@ -27,27 +27,20 @@ opacity = 0.8
 loc = 0
 
 xticks = []
-nhbonds = np.zeros([nsolutes], dtype=int)
 for i in solutes:
 
     sys = file_rw.load_object('%s/%s/10wt/hbonds.pl' % (path, i))
     res_numbers = sys.number_residues(i)[0]
 
-    single = np.zeros([sys.t.n_frames, nsolutes], dtype=bool)
-    double = np.zeros_like(single) 
-    triple = np.zeros_like(single)
-    quadruple = np.zeros_like(single)
-
+    nhbonds = np.zeros([sys.t.n_frames, nsolutes], dtype=int)  # number of hbonds each solute makes at each frame
     for t, a in enumerate(sys.hbonds):
-        nhbonds = np.zeros([nsolutes], dtype=int)
-        numbers = [res_numbers[j] for j in a[0]]
-        for k in numbers:
-            nhbonds[k] += 1
-
-        single[t, np.where(nhbonds == 1)[0]] = True
-        double[t, np.where(nhbonds == 2)[0]] = True
-        triple[t, np.where(nhbonds == 3)[0]] = True
-        quadruple[t, np.where(nhbonds == 4)[0]] = True
+        numbers = np.array([res_numbers[j] for j in a[0]], dtype=int)
+        nhbonds[t, :] = np.bincount(numbers, minlength=nsolutes)
+
+    single = nhbonds == 1
+    double = nhbonds == 2
+    triple = nhbonds == 3
+    quadruple = nhbonds == 4
 
     boot = np.zeros([5, nboot])
 
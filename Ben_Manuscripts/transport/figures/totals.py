@@ -44,7 +44,7 @@ for i, r in enumerate(residues):
 
 	zbox = rdf.t.unitcell_vectors[:, 2, 2].mean()
 	mean = rdf.density.mean(axis=0)
-	V = np.array([zbox * mean[i] * np.pi*(rdf.r[i + 1] ** 2 - rdf.r[i] ** 2) for i in range(len(rdf.r) - 1)])
+	V = zbox * mean[:-1] * np.pi * (rdf.r[1:] ** 2 - rdf.r[:-1] ** 2)
 	plt.plot(V)
 
 plt.ylabel('Density', fontsize=14)
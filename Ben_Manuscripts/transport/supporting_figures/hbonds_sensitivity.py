@@ -56,14 +56,12 @@ for j in combos:
         res_numbers = sys.number_residues(i)[0]
         for a in sys.hbonds:
             numbers = [res_numbers[x] for x in a[0]]
-            for k in numbers:
-                nhbonds[k] += 1
-            single += np.count_nonzero(nhbonds == 1)
-            double += np.count_nonzero(nhbonds == 2)
-            triple += np.count_nonzero(nhbonds == 3)
-            quadruple += np.count_nonzero(nhbonds == 4)
-
-            nhbonds -= nhbonds
+            nhbonds[:] = np.bincount(numbers, minlength=nsolutes)  # number of hbonds to each solute this frame
+            counts = np.bincount(nhbonds, minlength=5)  # number of solutes with 0, 1, 2, ... hbonds
+            single += counts[1]
+            double += counts[2]
+            triple += counts[3]
+            quadruple += counts[4]
 
         single /= sys.t.n_frames
         double /= sys.t.n_frames
@@ -20,19 +20,21 @@ def normalize_alkanes(R, Z, Raw_Intensity, inner, outer, angle, nbins=45):
 
     bins = np.linspace(-90, 90, nbins)
 
-    angles = []
-    intensity = []
+    RR, ZZ = np.meshgrid(R, Z, indexing='ij')  # RR[i, j] = R[i], ZZ[i, j] = Z[j]
+    r = np.hypot(RR, ZZ)
+    ring = (r > inner) & (r < outer)  # points inside the alkane region
+
+    # angle with respect to q_z = 0. arctan2 handles R == 0 (+/- 90 degrees) without a division. Its range is
+    # (-180, 180], so fold the R < 0 half-plane back onto [-90, 90] to match arctan(Z / R)
+    angles = (180 / np.pi) * np.arctan2(ZZ[ring], RR[ring])
+    angles[angles > 90] -= 180
+    angles[angles < -90] += 180
+    intensity = Raw_Intensity[ring]
 
-    count = 0
     test = np.zeros_like(Raw_Intensity)
-    for i in range(R.shape[0]):
-        for j in range(Z.shape[0]):
-            if inner < np.linalg.norm([R[i], Z[j]]) < outer:
-                angles.append((180 / np.pi) * np.arctan(Z[j] / R[i]))
-                count += 1
-                intensity.append(Raw_Intensity[i, j])
-                if -60 < angles[count - 1] < 60:
-                    test[i, j] = Raw_Intensity[i, j]
+    window = np.zeros_like(ring)
+    window[ring] = (angles > -60) & (angles < 60)
+    test[window] = Raw_Intensity[window]
 
     # fancy demo of r-alkanes normalization
     plt.figure()
@@ -54,11 +56,8 @@ def normalize_alkanes(R, Z, Raw_Intensity, inner, outer, angle, nbins=45):
 
     inds = np.digitize(angles, bins)
 
-    I = np.zeros([nbins])
-    counts = np.zeros([nbins])
-    for i in range(len(inds)):
-        I[inds[i] - 1] += intensity[i]
-        counts[inds[i] - 1] += 1
+    I = np.bincount(inds - 1, weights=intensity, minlength=nbins)
+    counts = np.bincount(inds - 1, minlength=nbins).astype(float)
 
     # Get average intensity in ring excluding 60 degree slice around top and bottom #######
 
@@ -134,8 +133,8 @@ qpi = 1.7  # q value of pi-stacking reflection
 axial = np.copy(waxs[:, int(waxs.shape[0]/2)])  # hold x constant at the center, and get all y values. The array is of the shape [y, x]
 mid = axial.shape[0] / 2
 axial[int(mid - 150):int(mid + 150)] = 0  # zero out middle values so we get the right maximum
-Imax = np.amax(axial)  # max value of Intensity. It will correspond to location of pi-stacking reflection
-Imax_pixel = np.where(axial == Imax)[0][0]
+Imax_pixel = np.argmax(axial)  # max value of Intensity. It will correspond to location of pi-stacking reflection
+Imax = axial[Imax_pixel]
 pixel_to_q = 1.7 / abs(mid - Imax_pixel)
 qmax = mid*pixel_to_q
 r_high_pix = 155 * pixel_to_q
@@ -143,11 +142,8 @@ r_low_pix = 215 * pixel_to_q
 
 # The raw data contains super high intensity specs and some intensity near the center that is meant to be blocked out
 # I zero out all of those so that the highest intensity is in the pi-stacking reflection.
-for i in range(23):
-    m = np.amax(waxs)
-    x = np.where(waxs == m)[0][0]
-    y = np.where(waxs == m)[1][0]
-    waxs[x, y] = 0
+hot = np.argpartition(waxs, -23, axis=None)[-23:]  # flat indices of the 23 brightest pixels
+waxs[np.unravel_index(hot, waxs.shape)] = 0  # waxs is a cropped view, so index it rather than its ravel()
 
 X = np.linspace(-qmax, qmax, waxs.shape[0])
 Y = np.linspace(-qmax, qmax, waxs.shape[1])
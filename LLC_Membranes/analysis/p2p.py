@@ -10,12 +10,16 @@ from pylab import *
 from scipy.interpolate import griddata
 from matplotlib import animation
 import argparse
+import hashlib
+import os
 from pymbar import timeseries
-import random as ran
 import mdtraj as md
 from scipy.optimize import curve_fit
 from scipy import spatial
 import tqdm
+from LLC_Membranes.llclib import file_rw
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'llc_membranes')
 
 
 def initialize():
@@ -45,6 +49,8 @@ def initialize():
     parser.add_argument('--auto_exclude', action="store_true", help="Specifying this will override args.exclude and "
                         "decide which pore-to-pore distance to exclude automatically by dropping the highest value")
     parser.add_argument('-b', '--nboot', default=2000, help='Number of bootstrap trials for generating statistics')
+    parser.add_argument('--nocache', action="store_true", help='Recalculate the equilibration frame and '
+                        'autocorrelation times even if they were cached by a previous run on identical distances')
 
     # plotting details
     parser.add_argument('--plot_every', default=1, type=int, help='Plot every n frames')
@@ -130,32 +136,25 @@ def avg_pore_loc(npores, pos, buffer=0):
         nT = np.shape(pos)[0]
         comp_ppore = np.shape(pos)[1] // npores
 
-        p_center = np.zeros([2, npores, nT])
-
-        for i in range(nT):
-            zmax = np.amax(pos[i, :, 2])  # maximum z value for this frame
-            zmin = np.amin(pos[i, :, 2])  # minimum z value for this frame
-            thick = zmax - zmin
-            zmax -= buffer*thick
-            zmin += buffer*thick
-            for j in range(npores):
-                count = 0
-                for k in range(comp_ppore*j, comp_ppore*(j + 1)):
-                    if zmax >= pos[i, k, 2] >= zmin:
-                        p_center[:, j, i] += pos[i, k, :2]
-                        count += 1
-                p_center[:, j, i] /= count  # take the average
+        zmax = np.amax(pos[:, :, 2], axis=1)  # maximum z value for each frame
+        zmin = np.amin(pos[:, :, 2], axis=1)  # minimum z value for each frame
+        thick = zmax - zmin
+        zmax -= buffer*thick
+        zmin += buffer*thick
+
+        # components are stored pore by pore, so group them as (nT, npores, comp_ppore)
+        pores = pos[:, :npores*comp_ppore, :].reshape(nT, npores, comp_ppore, 3)
+        include = (pores[..., 2] <= zmax[:, np.newaxis, np.newaxis]) & \
+                  (pores[..., 2] >= zmin[:, np.newaxis, np.newaxis])
+
+        total = (pores[..., :2] * include[..., np.newaxis]).sum(axis=2)  # (nT, npores, 2)
+        p_center = (total / include.sum(axis=2)[..., np.newaxis]).transpose(2, 1, 0)  # take the average
 
     elif len(pos.shape) == 2:  # single frame
 
         comp_ppore = pos.shape[0] // npores
 
-        p_center = np.zeros([2, npores])
-
-        for j in range(npores):
-            for k in range(comp_ppore*j, comp_ppore*(j + 1)):
-                p_center[:, j] += pos[k, :2]
-            p_center[:, j] /= comp_ppore
+        p_center = pos[:npores*comp_ppore, :2].reshape(npores, comp_ppore, 2).mean(axis=1).T
 
     else:
         return 'Please use a position array with valid dimensions'
@@ -176,22 +175,89 @@ def p2p(p_centers, distances):
     :return: (np.ndarray, shape(p_centers.shape[0], distances, 2) All frame-by-frame pore-to-pore distances
     """
 
-    nT = np.shape(p_centers)[2]
-    p2ps = np.zeros([distances, nT])  # distances in the order 1-2, 1-3, 1-4, 2-3, 2-4, 3-4
-    for i in range(nT):
-        # This could potentially be improved by figuring out an empirical formula for number of p2p distances of
-        # interest as a function of pores. Then only return the bottom x number of p2p distances.
-        p2ps[0, i] = np.linalg.norm(p_centers[:, 0, i] - p_centers[:, 1, i])
-        p2ps[1, i] = np.linalg.norm(p_centers[:, 0, i] - p_centers[:, 2, i])
-        p2ps[2, i] = np.linalg.norm(p_centers[:, 0, i] - p_centers[:, 3, i])
-        p2ps[3, i] = np.linalg.norm(p_centers[:, 1, i] - p_centers[:, 2, i])
-        p2ps[4, i] = np.linalg.norm(p_centers[:, 1, i] - p_centers[:, 3, i])
-        p2ps[5, i] = np.linalg.norm(p_centers[:, 2, i] - p_centers[:, 3, i])
+    # distances in the order 1-2, 1-3, 1-4, 2-3, 2-4, 3-4
+    # This could potentially be improved by figuring out an empirical formula for number of p2p distances of
+    # interest as a function of pores. Then only return the bottom x number of p2p distances.
+    a = np.array([0, 0, 0, 1, 1, 2])[:distances]
+    b = np.array([1, 2, 3, 2, 3, 3])[:distances]
+
+    p2ps = np.linalg.norm(p_centers[:, a, :] - p_centers[:, b, :], axis=0)  # (distances, nT)
 
     return p2ps
 
 
-def p2p_stats(p2ps, exclude, nboot, equil):
+def equilibration(p2ps, equil, ntau):
+    """ Find the frame at which the pore-to-pore distances are equilibrated and their autocorrelation times
+
+    :param p2ps: pore-to-pore distances with excluded distances already removed
+    :param equil: the trajectory frame at which the system is equilibrated or 'auto' to detect it with pymbar
+    :param ntau: number of distances (starting from the first) for which to calculate autocorrelation times
+
+    :type p2ps: numpy.ndarray, shape(ndistances, nframes)
+    :type equil: int or str
+    :type ntau: int
+
+    :return: equilibrated frame and the autocorrelation time of each distance
+    """
+
+    # Find the frame at which the system is equilibrated
+    if equil == 'auto':
+        ts = []
+        for pore in range(p2ps.shape[0]):
+            ts.append(timeseries.detectEquilibration(p2ps[pore, :])[0])
+        t = int(max(ts))  # use the max equil frame to ensure all pores are equilibrated
+    else:
+        t = int(equil)
+
+    # Find the autocorrelation time for each pore - i.e. the time it takes for samples to become uncorrelated
+    taus = []
+    for i in range(ntau):
+        tau = timeseries.integratedAutocorrelationTime(p2ps[i, t:])
+        taus.append(tau)
+
+    return t, taus
+
+
+def cached_equilibration(p2ps, equil, ntau, cache_dir=CACHE_DIR):
+    """ Same as equilibration(), but results are pickled to disk and reused on later calls with identical input. Both
+    pymbar routines scale quadratically with trajectory length, so this makes re-plotting essentially free.
+
+    :param p2ps: pore-to-pore distances with excluded distances already removed
+    :param equil: the trajectory frame at which the system is equilibrated or 'auto' to detect it with pymbar
+    :param ntau: number of distances (starting from the first) for which to calculate autocorrelation times
+    :param cache_dir: directory where cached results are stored
+
+    :type p2ps: numpy.ndarray, shape(ndistances, nframes)
+    :type equil: int or str
+    :type ntau: int
+    :type cache_dir: str
+
+    :return: equilibrated frame and the autocorrelation time of each distance
+    """
+
+    p2ps = np.ascontiguousarray(p2ps, dtype=float)
+
+    key = hashlib.blake2b(p2ps.tobytes())
+    key.update(('%s %s %s' % (p2ps.shape, equil, ntau)).encode())
+    cache = os.path.join(cache_dir, 'p2p_equil_%s.pl' % key.hexdigest())
+
+    if os.path.isfile(cache):
+        return file_rw.load_object(cache)
+
+    results = equilibration(p2ps, equil, ntau)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        file_rw.save_object(results, cache)
+    except OSError as e:  # caching is only an optimization, so don't let an unwritable cache stop the analysis
+        print('Could not cache equilibration results in %s: %s' % (cache_dir, e))
+        if os.path.isfile(cache):
+            os.remove(cache)  # don't leave a partially written file to be loaded next time
+
+    return results
+
+
+def p2p_stats(p2ps, exclude, nboot, equil, cache=False):
     """ Calculate the average and spread of pore-to-pore distances
 
     :param p2ps: all of the pore-to-pore distances
@@ -200,11 +266,14 @@ def p2p_stats(p2ps, exclude, nboot, equil):
     :param nboot: number of bootstrap trials to use when generating statistics
     :param equil: the trajectory frame at which to start generating statistics. Care about this parameter if you
            choose to detect equilibration manually. Otherwise 'auto' will use pymbar to find it for you
+    :param cache: store the equilibration frame and autocorrelation times on disk (see cached_equilibration) and reuse
+           them on later calls with identical data
 
     :type p2ps: numpy.ndarray, shape(nframes, np2p_distances)
     :type exclude: int or str
     :type nboot: int
     :type equil: int or str
+    :type cache: bool
 
     :return: the average and standard deviation of pore to pore distances
     """
@@ -224,20 +293,11 @@ def p2p_stats(p2ps, exclude, nboot, equil):
 
     p2ps = p2p_new
 
-    # Find the frame at which the system is equilibrated
-    if equil == 'auto':
-        ts = []
-        for pore in range(ndist):
-            ts.append(timeseries.detectEquilibration(p2ps[pore, :])[0])
-        t = int(max(ts))  # use the max equil frame to ensure all pores are equilibrated
+    # Find the equilibrated frame and the autocorrelation time for each pore
+    if cache:
+        t, taus = cached_equilibration(p2ps, equil, ndist - len(exclude))
     else:
-        t = int(equil)
-
-    # Find the autocorrelation time for each pore - i.e. the time it takes for samples to become uncorrelated
-    taus = []
-    for i in range(ndist - len(exclude)):
-        tau = timeseries.integratedAutocorrelationTime(p2ps[i, t:])
-        taus.append(tau)
+        t, taus = equilibration(p2ps, equil, ndist - len(exclude))
 
     print('Maximum Autocorrelation Time: %s frames' % max(taus))
     tau = int(np.ceil(max(taus)))  # use the max again to ensure all trajectories are independent. np.ceil e
@@ -248,22 +308,14 @@ def p2p_stats(p2ps, exclude, nboot, equil):
     ind_trajectories = (nT - t) // tau  # the number of independent trajectories
     print('%s Independent Trajectories' % ind_trajectories)
 
-    trajectories = np.zeros([ndist, ind_trajectories, tau])  # Create a new array to hold all the trajectories
-
-    # fill up trajectory array
-    for i in range(ndist):
-        for j in range(ind_trajectories):
-            # trajectories[i*ind_trajectories + j, :] = p2ps[i, (t + j*tau):(t + (j + 1)*tau)]
-            trajectories[i, j, :] = p2ps[i, (t + j*tau):(t + (j + 1)*tau)]
+    # split the equilibrated part of each distance into independent trajectories of length tau
+    trajectories = p2ps[:, t:(t + ind_trajectories*tau)].reshape(ndist, ind_trajectories, tau)
 
-    # bootstrap to get statistics
-    p2p_boot = np.zeros([nboot, ndist, ind_trajectories*tau])  # a bunch of full trajectories assembled from independent trajectories
-    avg_trials = np.zeros([nboot, ndist])
-    for i in range(nboot):
-        for k in range(ind_trajectories):
-            T = ran.randrange(0, ind_trajectories)  # pick a random trajectory from all the independent trajectories
-            p2p_boot[i, :, k*tau:(k+1)*tau] = trajectories[:, T, :]
-        avg_trials[i, :] = np.mean(p2p_boot[i, :, :], axis=1)  # Average value of each pore for each trial
+    # bootstrap to get statistics. Every independent trajectory has the same length, so the average of a full
+    # trajectory assembled from randomly chosen independent trajectories is the average of their individual means
+    traj_means = trajectories.mean(axis=2)  # (ndist, ind_trajectories)
+    T = np.random.randint(0, ind_trajectories, size=(nboot, ind_trajectories))  # random picks for each trial
+    avg_trials = traj_means[:, T].mean(axis=2).T  # Average value of each pore for each trial, (nboot, ndist)
 
     average_distances = np.mean(avg_trials, axis=0)
     avg = np.mean(average_distances)
@@ -325,7 +377,8 @@ def parse_txt(txt, points, times, std=False):
             begin = np.where(times == time[i])[0][0]
             end = np.where(times == time[i + 1])[0][0]
             slice = p2ps[:, begin:end]
-            p2p_avg, p2p_std, equil = p2p_stats(slice, exclude, '%s' % args.nboot, '%s' % args.equil)
+            p2p_avg, p2p_std, equil = p2p_stats(slice, exclude, '%s' % args.nboot, '%s' % args.equil,
+                                                cache=not args.nocache)
             std_equil[:, i] = [p2p_avg, p2p_std, equil + begin, end]
 
         for i in range(std_equil.shape[1]):
@@ -401,7 +454,7 @@ if __name__ == '__main__':
     else:
         exclude = [int(i) for i in args.exclude]
 
-    p2p_avg, p2p_std, equil = p2p_stats(p2ps, exclude, '%s' % args.nboot, '%s' % args.equil)
+    p2p_avg, p2p_std, equil = p2p_stats(p2ps, exclude, '%s' % args.nboot, '%s' % args.equil, cache=not args.nocache)
     print('Equilibration detected after %d ns' % (t.time[equil] / 1000))
     print('Average Pore to Pore distance: %.3f' % p2p_avg)
     print('Standard Deviation of Pore to Pore distances: %.3f' % p2p_std)
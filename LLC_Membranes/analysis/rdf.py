@@ -255,11 +255,8 @@ class System(object):
             # self.density[b, :] = trial / (nT * self.npores)
 
         # normalize based on volume of anulus where bin is located (just need to divide by area since height done above)
-        self.r = np.zeros([nbins])
-        for i in range(nbins):
-            # density[:, i] /= area
-            self.density[:, i] /= (np.pi * (bin_edges[i + 1] ** 2 - bin_edges[i] ** 2))
-            self.r[i] = (bin_edges[i + 1] + bin_edges[i]) / 2  # center of bins
+        self.density /= np.pi * (bin_edges[1:] ** 2 - bin_edges[:-1] ** 2)  # area of each anulus
+        self.r = (bin_edges[1:] + bin_edges[:-1]) / 2  # center of bins
 
         lower_confidence = (100 - confidence) / 2
         upper_confidence = 100 - lower_confidence
@@ -3,11 +3,6 @@
 """
 Calculate the tilt angle of alkyl chains
 """
-from __future__ import division
-from __future__ import print_function
-
-from builtins import range
-from past.utils import old_div
 import argparse
 import numpy as np
 import mdtraj as md
@@ -16,6 +11,7 @@ import copy
 import math
 import matplotlib.pyplot as plt
 from matplotlib import animation
+from multiprocessing import Pool
 import tqdm
 
 
@@ -37,6 +33,8 @@ def initialize():
     parser.add_argument('--plot_every', default=1, type=int, help='Plot every n frames')
     parser.add_argument('-b', '--begin', default=0, type=int, help='Start frame')
     parser.add_argument('--skip', default=1, type=int, help='Only look at every nth frame')
+    parser.add_argument('-nt', '--nthreads', default=1, type=int, help='Number of processes to split trajectory frames '
+                        'across when calculating angles')
 
     args = parser.parse_args()
 
@@ -65,39 +63,66 @@ def read_index(index):
     return grps
 
 
-def angles(pos, atoms, normal=[0, 0, 1]):
+def angles(pos, atoms, normal=[0, 0, 1], chunk=500):
     """
     :param pos: xyz positions of atoms in tail
     :param atoms: number of atoms
     :param normal: the normal vector to the plane with respect to which we will take an angle measurement
+    :param chunk: number of frames to process at once. Limits the size of the temporary bond vector arrays for long
+    trajectories
     :return: the angle distribution at each frame
     """
 
-    normal = np.array(normal)
+    normal = np.array(normal, dtype=float)
+    normal /= np.linalg.norm(normal)
     nT = pos.shape[0]
     natoms = pos.shape[1]
-    chains = old_div(natoms, atoms)
+    chains = natoms // atoms
     w = np.zeros([nT, chains])
 
-    count = 0
-    for i in tqdm.tqdm(range(nT)):
-        for j in range(chains):
-            avg_tilt = 0
-            for k in range(atoms - 1):  # atoms - 1 since there are n - 1 relevant vectors in a straight chain
-                # MOST IMPORTANT BLOCK
-                v = pos[i, j*atoms + k + 1, :] - pos[i, j*atoms + k, :]
-                vn = np.dot(v, normal)
-                nn = np.linalg.norm(normal)
-                vv = np.linalg.norm(v)
-                avg_tilt += np.arcsin(old_div(vn, (nn * vv))) * (old_div(180, np.pi))
-                count += 1
-            avg_tilt /= (atoms - 1)
-
-            w[i, j] = avg_tilt
+    axis = np.flatnonzero(normal)  # a single entry if the normal lies along x, y or z
+    if axis.size == 1:
+        k = axis[0]
+        others = [d for d in range(3) if d != k]
+
+    for start in range(0, nT, chunk):
+
+        p = pos[start:(start + chunk), :chains*atoms, :].reshape(-1, chains, atoms, 3)
+
+        v = p[:, :, 1:, :] - p[:, :, :-1, :]  # atoms - 1 since there are n - 1 relevant vectors in a straight chain
+
+        # tilt = arctan(component along normal / component in the plane). Same as arcsin(vn / |v|), but without a
+        # division and well conditioned for bonds that are nearly parallel to the normal
+        if axis.size == 1:
+            vn = normal[k] * v[..., k]
+            vplane = np.hypot(v[..., others[0]], v[..., others[1]])
+        else:
+            vn = v @ normal
+            vplane = np.linalg.norm(np.cross(v, normal), axis=-1)
+
+        w[start:(start + chunk), :] = (np.arctan2(vn, vplane) * (180 / np.pi)).mean(axis=-1)  # average chain tilt
 
     return w
 
 
+def parallel_angles(pos, atoms, nt, normal=[0, 0, 1]):
+    """ Calculate tilt angles with trajectory frames divided evenly between processes
+
+    :param pos: xyz positions of atoms in tail
+    :param atoms: number of atoms
+    :param nt: number of processes
+    :param normal: the normal vector to the plane with respect to which we will take an angle measurement
+    :return: the angle distribution at each frame
+    """
+
+    if nt > 1:
+        with Pool(nt) as pool:
+            w = pool.starmap(angles, [(p, atoms, normal) for p in np.array_split(pos, nt)])
+        return np.concatenate(w)
+    else:
+        return angles(pos, atoms, normal)
+
+
 def bootstrap(angles, nboot):
 
     angles = angles.flatten()
@@ -121,8 +146,9 @@ if __name__ == "__main__":
     # atoms = list(itertools.chain.from_iterable(grps))
 
     if args.load:
-        all_tilt_angles = np.load('angles.npy')
-        times = np.load('times.npy')
+        # memory-map rather than reading the files up front. Data is paged in as the reductions below touch it
+        all_tilt_angles = np.load('angles.npy', mmap_mode='r')
+        times = np.load('times.npy', mmap_mode='r')
         print('arrays loaded')
     else:
         if args.single_frame:
@@ -131,21 +157,26 @@ if __name__ == "__main__":
             traj = md.load('%s' % args.traj, top='%s' % args.gro)[args.begin::args.skip]
         times = traj.time
         nT = times.shape[0]
+        name_to_indices = {}  # indices of atoms with each name, so the topology is only traversed once
+        for a in traj.topology.atoms:
+            name_to_indices.setdefault(a.name, []).append(a.index)
         for i in range(ngrps):
             atoms = grps[i]
-            keep = [a.index for a in traj.topology.atoms if a.name in atoms]  # restrict trajectory to chosen atoms
-            t = traj.atom_slice(keep)  # NOTE: it's probably just luck that the atoms are written in order of their
-                                    # connectivity. A reordering function may be necessary in the future
-            pos = t.xyz  # get just the coordinates
+            # restrict trajectory to chosen atoms
+            keep = sorted(itertools.chain.from_iterable(name_to_indices.get(n, []) for n in set(atoms)))
+            # get just the coordinates. Indexing xyz directly avoids building a new trajectory and topology with
+            # atom_slice. NOTE: it's probably just luck that the atoms are written in order of their connectivity. A
+            # reordering function may be necessary in the future
+            pos = traj.xyz[:, np.asarray(keep, dtype=np.intp), :]
             if i == 0:
-                all_tilt_angles = angles(pos, len(atoms))
+                all_tilt_angles = parallel_angles(pos, len(atoms), args.nthreads)
             else:
-                tilt_angles_grp = angles(pos, len(atoms))
+                tilt_angles_grp = parallel_angles(pos, len(atoms), args.nthreads)
                 all_tilt_angles = np.concatenate((all_tilt_angles, tilt_angles_grp), axis=1)
 
         if args.save:
-            np.save('angles', all_tilt_angles)
-            np.save('times', times)
+            np.save('angles.npy', all_tilt_angles)
+            np.save('times.npy', times)
             print("Arrays saved")
 
     if args.single_frame:
@@ -160,7 +191,7 @@ if __name__ == "__main__":
         #bootstrapped = bootstrap(all_tilt_angles, nboot=1000) needs work.
 
         nT = all_tilt_angles.shape[0]
-        plt.hist(all_tilt_angles.flatten(), bins=50, normed=True)
+        plt.hist(all_tilt_angles.ravel(), bins=50, normed=True)  # ravel avoids copying the (contiguous) array
         # plt.hist(bootstrapped.flatten(), bins=50, normed=True)
         avg = np.mean(all_tilt_angles)
         plt.plot([avg, avg], [0, 0.035], '--', color='black')
@@ -175,14 +206,10 @@ if __name__ == "__main__":
         # exit()
         # print(all_tilt_angles.shape)
         # exit()
-        avgs = np.zeros([nT])
-        stds = np.zeros([nT])
-
-        for i in range(nT):
-            stds[i] = np.std(all_tilt_angles[i, :])
-            avgs[i] = np.mean(all_tilt_angles[i, :])
+        avgs = np.mean(all_tilt_angles, axis=1)
+        stds = np.std(all_tilt_angles, axis=1)
 
-        print('Average tilt angle : %s +/- %s' % (np.mean(avgs[old_div(nT,2):]), np.mean(stds[old_div(nT,2):])))
+        print('Average tilt angle : %s +/- %s' % (np.mean(avgs[nT // 2:]), np.mean(stds[nT // 2:])))
         # Format and save figure
         plt.figure()
         plt.errorbar(times[::args.plot_every], avgs[::args.plot_every], yerr=stds[::args.plot_every])
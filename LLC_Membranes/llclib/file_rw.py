@@ -7,68 +7,112 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 import numpy as np
-import copy
+import functools
 import math
 import os
 import pickle
 
+# hexagonal packing of 4 pores: (x, y) offset of each pore center from the first, in units of the pore spacing
+_SIN30 = 0.5
+_COS30 = math.sqrt(3) / 2
+_PORE_OFFSETS = ((0, 0), (-1, 0), (-_SIN30, -_COS30), (_SIN30, -_COS30))
+_ION_PORE_OFFSETS = ((0, 0), (-1, 0), (_SIN30, -_COS30), (-_SIN30, -_COS30))  # ions of pores 2 and 3 are swapped
+
 
 def read_pdb_coords(file):
 
-    a = []
-    for line in file:
-        a.append(line)
+    a = file.readlines()
     file.close()
 
-    no_atoms = 0  # number of atoms in one monomer including sodium ion
-    for i in range(0, len(a)):
-        no_atoms += a[i].count('ATOM')
+    no_atoms = sum(line.count('ATOM') for line in a)  # number of atoms in one monomer including sodium ion
+    lines_of_text = next((i for i, line in enumerate(a) if 'ATOM' in line), len(a))  # lines of text at top of file
 
-    lines_of_text = 0  # lines of text at top of .pdb input file
-    for i in range(0, len(a)):
-        if a[i].count('ATOM') == 0:
-            lines_of_text += 1
-        if a[i].count('ATOM') == 1:
-            break
+    atoms = a[lines_of_text:(lines_of_text + no_atoms)]  # relevant lines of text in file, f, being read
 
-    xyz = np.zeros([3, no_atoms])
-    identity = np.zeros([no_atoms], dtype=object)
-    for i in range(lines_of_text, lines_of_text + no_atoms):  # searches relevant lines of text in file, f, being read
-        xyz[:, i - lines_of_text] = [float(a[i][26:38]), float(a[i][38:46]), float(a[i][46:54])]  # Use this to read specific entries in a text file
-        identity[i - lines_of_text] = str.strip(a[i][12:16])
+    # slice out the fixed-width fields and let numpy convert all of them at once
+    xyz = np.array([(line[26:38], line[38:46], line[46:54]) for line in atoms], dtype=float).reshape(no_atoms, 3).T
+    identity = np.array([line[12:16].strip() for line in atoms], dtype=object)
 
     return xyz, identity, no_atoms, lines_of_text
 
 
 def read_gro_coords(file):
 
-    a = []
-    for line in file:
-        a.append(line)
+    a = file.readlines()
     file.close()
 
     lines_of_text = 2  # Hard Coded -> BAD .. but I've seen this in mdtraj scripts
     no_atoms = len(a) - lines_of_text - 1  # subtract one for the bottom box vector line
 
-    xyz = np.zeros([3, no_atoms])
-    identity = np.zeros([no_atoms], dtype=object)
-    for i in range(lines_of_text, lines_of_text + no_atoms):  # searches relevant lines of text in file, f, being read
-        xyz[:, i - lines_of_text] = [float(a[i][20:28])*10, float(a[i][28:36])*10, float(a[i][36:44])*10]
-        identity[i - lines_of_text] = str.strip(a[i][11:16])
+    atoms = a[lines_of_text:(lines_of_text + no_atoms)]  # relevant lines of text in file, f, being read
+
+    # slice out the fixed-width fields and let numpy convert all of them at once
+    xyz = np.array([(line[20:28], line[28:36], line[36:44]) for line in atoms], dtype=float).reshape(no_atoms, 3).T * 10
+    identity = np.array([line[11:16].strip() for line in atoms], dtype=object)
 
     return xyz, identity, no_atoms, lines_of_text
 
 
-def write_assembly(b, output, no_mon, xlink=False):
+def _section_length(a, start):
+    """ Count the lines of a topology section
+
+    :param a: lines of the topology file
+    :param start: index of the first line of the section (after its header and comments)
+
+    :type a: list
+    :type start: int
+
+    :return: number of lines from a[start] up to, but not including, the next blank line or the end of the file
+    """
+
+    try:
+        return a.index('\n', start) - start
+    except ValueError:  # the section runs to the end of the file
+        return len(a) - start
+
+
+@functools.lru_cache(maxsize=32)
+def _load_itp_cached(filename, mtime, xlink):
+
+    with open(filename, 'r') as f:
+        a = tuple(f)
+
+    return a, get_indices(a, xlink)
+
+
+def _load_itp(filename, xlink):
+    """ Read a topology file and locate its sections. Repeated loads of an unmodified file within the same process are
+    served from memory. The file's modification time is part of the cache key, so a file that is edited is read again.
+
+    :param filename: name of topology (.itp) file
+    :param xlink: whether the system is being cross-linked
+
+    :type filename: str
+    :type xlink: bool
+
+    :return: lines of the file and the indices of its sections (see get_indices). Both are copies, so they can be
+    modified without affecting the cache
+    """
+
+    filename = os.path.abspath(filename)
+    a, indices = _load_itp_cached(filename, os.path.getmtime(filename), xlink)
+
+    return list(a), dict(indices)
+
+
+def write_assembly(b, output, no_mon, xlink=False, top_location=None):
     """
     :param b: Name of build monomer (string)
     :param output: name of output file
     :param no_mon: number of monomers in the assembly
     :param xlink : whether the system is being cross-linked
+    :param top_location: directory containing the monomer topologies. Defaults to LLC_Membranes/top/topologies
     :return:
     """
     # print up to ' [ atoms ] ' since everything before it does not need to be modified
-    location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))  # Location of this script
+    if top_location is None:
+        location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))  # Location of this script
+        top_location = "%s/../top/topologies" % location
     nres = len(b)  # number of different residues
 
     section_indices = []
@@ -77,20 +121,21 @@ def write_assembly(b, output, no_mon, xlink=False):
 
         if type(res) is list:  # restrain.py might pass in an already modified topology that isn't in the below folders
             itps.append(b)
+            section_indices.append(get_indices(itps[m], xlink))
         else:
-            with open("%s/../top/topologies/%s" % (location, '%s.itp' % res), "r") as f:
-                a = []
-                for line in f:
-                    a.append(line)
+            a, indices = _load_itp("%s/%s.itp" % (top_location, res), xlink)
             itps.append(a)
+            section_indices.append(indices)
 
-        section_indices.append(get_indices(itps[m], xlink))
         # atoms_index, bonds_index, pairs_index, angles_index, dihedrals_p_index, \
         # dihedrals_imp_index, vsite_index, vtype = get_indices(a, xlink)
 
     # for i in range(0, atoms_index + 2):  # prints up to and including [ atoms ] in addition to the header line after it
     #     f.write(a[i])
 
+    # Each section of each residue's topology is parsed once. The monomer-independent pieces are then reused to build
+    # the lines for every monomer, and each section is written to the output file in a single call
+
     f = open('%s' % output, 'w')
 
     f.write('[ moleculetype ]\n')
@@ -105,19 +150,21 @@ def write_assembly(b, output, no_mon, xlink=False):
 
         a = itps[r]
         atoms_index = section_indices[r]['atoms_index']
-        atoms_count = atoms_index + 2
-        nr = 0  # number of atoms
-        while a[atoms_count] != '\n':
-            atoms_count += 1  # increments the while loop
-            nr += 1  # counts number of atoms
+        nr = _section_length(a, atoms_index + 2)  # number of atoms
 
         natoms.append(nr)
 
+        lines = a[(atoms_index + 2):(atoms_index + 2 + nr)]
+        names = [line[6:29] for line in lines]
+        cgnr = [int(line[29:34]) for line in lines]
+        rest = [line[34:] for line in lines]
+
+        out = []
         for i in range(int(no_mon[r])):  # print atom information for each monomer
             for k in range(0, nr):  # getting the number right
-                f.write('{:5d}{:25s}{:5d}{:}'.format(i*nr + k + 1 + start_ndx, a[k + atoms_index + 2][6:29],
-                                                   i*nr + int(a[k + atoms_index + 2][29:34]) + start_ndx,
-                                                   a[k + atoms_index + 2][34:len(a[k + atoms_index + 2])]))
+                out.append('{:5d}{:25s}{:5d}{:}'.format(i*nr + k + 1 + start_ndx, names[k], i*nr + cgnr[k] + start_ndx,
+                                                        rest[k]))
+        f.write(''.join(out))
 
         start_ndx = int(no_mon[r]*nr)
 
@@ -131,19 +178,19 @@ def write_assembly(b, output, no_mon, xlink=False):
         a = itps[r]
         bonds_index = section_indices[r]['bonds_index']
 
-        nb = 0  # number of lines in the 'bonds' section
-        bond_count = bonds_index + 2
-        while a[bond_count] != '\n':
-            bond_count += 1  # increments while loop
-            nb += 1  # counting number of lines in 'bonds' section
+        nb = _section_length(a, bonds_index + 2)  # number of lines in the 'bonds' section
 
         nr = natoms[r]
 
+        lines = a[(bonds_index + 2):(bonds_index + 2 + nb)]
+        bonds = [(int(line[0:6]), int(line[6:14]), line[14:]) for line in lines]
+
+        out = []
         for i in range(int(no_mon[r])):
-            for k in range(0, nb):
-                f.write('{:6d}{:7d}{:}'.format(i*nr + int(a[k + bonds_index + 2][0:6]) + start_ndx,
-                                               i*nr + int(a[k + bonds_index + 2][6:14]) + start_ndx,
-                                               a[k + bonds_index + 2][14:]))
+            offset = i*nr + start_ndx
+            for ai, aj, rest in bonds:
+                out.append('{:6d}{:7d}{:}'.format(ai + offset, aj + offset, rest))
+        f.write(''.join(out))
 
         start_ndx = int(no_mon[r]*nr)
 
@@ -158,17 +205,17 @@ def write_assembly(b, output, no_mon, xlink=False):
         pairs_index = section_indices[r]['pairs_index']
         nr = natoms[r]
 
-        npair = 0  # number of lines in the 'pairs' section
-        pairs_count = pairs_index + 2  # keep track of index of a
-        while a[pairs_count] != '\n':
-            pairs_count += 1
-            npair += 1
+        npair = _section_length(a, pairs_index + 2)  # number of lines in the 'pairs' section
 
+        lines = a[(pairs_index + 2):(pairs_index + 2 + npair)]
+        pairs = [(int(line[0:6]), int(line[6:14]), line[14:]) for line in lines]
+
+        out = []
         for i in range(int(no_mon[r])):
-            for k in range(0, npair):
-                f.write('{:6d}{:7d}{:}'.format(i*nr + int(a[k + pairs_index + 2][0:6]) + start_ndx,
-                                               i*nr + int(a[k + pairs_index + 2][6:14]) + start_ndx,
-                                               a[k + pairs_index + 2][14:len(a[k + pairs_index + 2])]))
+            offset = i*nr + start_ndx
+            for ai, aj, rest in pairs:
+                out.append('{:6d}{:7d}{:}'.format(ai + offset, aj + offset, rest))
+        f.write(''.join(out))
 
         start_ndx = int(no_mon[r] * nr)
 
@@ -182,20 +229,20 @@ def write_assembly(b, output, no_mon, xlink=False):
         a = itps[r]
         angles_index = section_indices[r]['angles_index']
 
-        na = 0  # number of lines in the 'angles' section
-        angle_count = angles_index + 2  # keep track of index of a
-        while a[angle_count] != '\n':
-            angle_count += 1
-            na += 1
+        na = _section_length(a, angles_index + 2)  # number of lines in the 'angles' section
 
         nr = natoms[r]
 
+        lines = a[(angles_index + 2):(angles_index + 2 + na)]
+        angles = [(int(line[0:6]), int(line[6:14]), int(line[14:22]), line[22:]) for line in lines]
+
+        out = []
         for i in range(int(no_mon[r])):
-            for k in range(0, na):
-                f.write('{:6d}{:7d}{:7d}{:}'.format(i*nr + int(a[k + angles_index + 2][0:6]) + start_ndx,
-                                                    i*nr + int(a[k + angles_index + 2][6:14]) + start_ndx,
-                                                    i*nr + int(a[k + angles_index + 2][14:22]) + start_ndx,
-                                                    a[k + angles_index + 2][22:len(a[k + angles_index + 2])]))
+            offset = i*nr + start_ndx
+            for ai, aj, ak, rest in angles:
+                out.append('{:6d}{:7d}{:7d}{:}'.format(ai + offset, aj + offset, ak + offset, rest))
+        f.write(''.join(out))
+
         start_ndx = int(no_mon[r] * nr)
 
     # [ dihedrals ] ; propers
@@ -209,25 +256,20 @@ def write_assembly(b, output, no_mon, xlink=False):
         dihedrals_p_index = section_indices[r]['dihedrals_p_index']
 
         # TODO: rewrite these so they just ignore all the comment lines
-        ndp = 0  # number of lines in the 'dihedrals ; proper' section
-        dihedrals_p_count = dihedrals_p_index + 3  # keep track of index of a
-        while a[dihedrals_p_count] != '\n':
-            dihedrals_p_count += 1
-            ndp += 1
+        ndp = _section_length(a, dihedrals_p_index + 3)  # number of lines in the 'dihedrals ; proper' section
 
         nr = natoms[r]
 
+        lines = a[(dihedrals_p_index + 3):(dihedrals_p_index + 3 + ndp)]
+        dihedrals = [[int(x) for x in line.split()[:5]] for line in lines]
+
+        out = []
         for i in range(int(no_mon[r])):
-            for k in range(0, ndp):
-                info = [int(x) for x in a[k + dihedrals_p_index + 3].split()[:5]]
-                # f.write('{:6d}{:7d}{:7d}{:7d}{:}'.format(i*nr + int(a[k + dihedrals_p_index + 3][0:6]),
-                #                                        i*nr + int(a[k + dihedrals_p_index + 3][6:14]),
-                #                                        i*nr + int(a[k + dihedrals_p_index + 3][14:22]),
-                #                                        i*nr + int(a[k + dihedrals_p_index + 3][22:30]),
-                #                                        a[k + dihedrals_p_index + 3][30:len(a[k + dihedrals_p_index + 3])]))
-                f.write('{:6d}{:7d}{:7d}{:7d}{:7d}\n'.format(i * nr + info[0] + start_ndx, i * nr + info[1] + start_ndx,
-                                                             i * nr + info[2] + start_ndx, i * nr + info[3] + start_ndx,
-                                                             info[4]))
+            offset = i*nr + start_ndx
+            for info in dihedrals:
+                out.append('{:6d}{:7d}{:7d}{:7d}{:7d}\n'.format(info[0] + offset, info[1] + offset, info[2] + offset,
+                                                                info[3] + offset, info[4]))
+        f.write(''.join(out))
 
         start_ndx = int(no_mon[r] * nr)
 
@@ -241,22 +283,22 @@ def write_assembly(b, output, no_mon, xlink=False):
         a = itps[r]
         dihedrals_imp_index = section_indices[r]['dihedrals_imp_index']
 
-        ndimp = 0  # number of lines in the 'dihedrals ; impropers' section
-        dihedrals_imp_count = dihedrals_imp_index + 3
-
-        while dihedrals_imp_count < len(a) and a[dihedrals_imp_count] != '\n':
-            dihedrals_imp_count += 1
-            ndimp += 1
+        ndimp = _section_length(a, dihedrals_imp_index + 3)  # number of lines in the 'dihedrals ; impropers' section
 
         nr = natoms[r]
 
+        lines = a[(dihedrals_imp_index + 3):(dihedrals_imp_index + 3 + ndimp)]
+        dihedrals = [[int(x) for x in line.split()[:5]] for line in lines]
+
         # Can't have any space at the bottom of the file for this loop to work
+        out = []
         for i in range(int(no_mon[r])):
-            for k in range(0, ndimp):
-                info = [int(x) for x in a[k + dihedrals_imp_index + 3].split()[:5]]
-                f.write('{:6d}{:7d}{:7d}{:7d}{:7d}\n'.format(i * nr + info[0] + start_ndx, i * nr + info[1] + start_ndx,
-                                                             i * nr + info[2] + start_ndx, i * nr + info[3] + start_ndx,
-                                                             info[4]))
+            offset = i*nr + start_ndx
+            for info in dihedrals:
+                out.append('{:6d}{:7d}{:7d}{:7d}{:7d}\n'.format(info[0] + offset, info[1] + offset, info[2] + offset,
+                                                                info[3] + offset, info[4]))
+        f.write(''.join(out))
+
         start_ndx = int(no_mon[r] * nr)
 
     f.write("\n")  # space in between sections
@@ -274,38 +316,34 @@ def write_assembly(b, output, no_mon, xlink=False):
 
             a = itps[r]
 
-            nv = 0
-            vsite_count = vsite_index + 2
-
-            for i in range(vsite_count, len(a)):  # This is the last section in the input .itp file
-                vsite_count += 1
-                nv += 1
+            nv = len(a) - (vsite_index + 2)  # This is the last section in the input .itp file
 
             nr = natoms[r]
 
+            out = []
             if section_indices[r]['vtype'] == '3fd':
+                lines = a[(vsite_index + 1):(vsite_index + 1 + nv)]
+                vsites = [(int(line[0:6]), int(line[6:12]), int(line[12:18]), int(line[18:24]), int(line[24:30]),
+                           float(line[30:38]), float(line[38:])) for line in lines]
                 for i in range(int(no_mon[r])):
-                    for k in range(nv):
-                        f.write('{:<6d}{:<6d}{:<6d}{:<6d}{:<6d}{:<8.4f}{:<8.4f}\n'.format(
-                            i*nr + int(a[k + vsite_index + 1][0:6]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 1][6:12]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 1][12:18]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 1][18:24]) + start_ndx,
-                            int(a[k + vsite_index + 1][24:30]), float(a[k + vsite_index + 1][30:38]),
-                            float(a[k + vsite_index + 1][38:])))
+                    offset = i*nr + start_ndx
+                    for v in vsites:
+                        out.append('{:<6d}{:<6d}{:<6d}{:<6d}{:<6d}{:<8.4f}{:<8.4f}\n'.format(
+                            v[0] + offset, v[1] + offset, v[2] + offset, v[3] + offset, v[4], v[5], v[6]))
             elif xlink:
 
                 # Make sure there is no space at the bottom of the topology if you are getting errors
+                lines = a[(vsite_index + 2):(vsite_index + 2 + nv)]
+                vsites = [(int(line[0:8]), int(line[8:14]), int(line[14:20]), int(line[20:26]), int(line[26:34]),
+                           int(line[34:42]), line[42:53], line[53:64], line[64:]) for line in lines]
                 for i in range(int(no_mon[r])):
-                    for k in range(0, nv):
-                        f.write('{:<8d}{:<6d}{:<6d}{:<6d}{:<8d}{:<8d}{:<11}{:<11}{:}'.format(
-                            i*nr + int(a[k + vsite_index + 2][0:8]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 2][8:14]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 2][14:20]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 2][20:26]) + start_ndx,
-                            i*nr + int(a[k + vsite_index + 2][26:34]) + start_ndx,
-                            int(a[k + vsite_index + 2][34:42]), a[k + vsite_index + 2][42:53],
-                            a[k + vsite_index + 2][53:64], a[k + vsite_index + 2][64:len(a[k + vsite_index + 2])]))
+                    offset = i*nr + start_ndx
+                    for v in vsites:
+                        out.append('{:<8d}{:<6d}{:<6d}{:<6d}{:<8d}{:<8d}{:<11}{:<11}{:}'.format(
+                            v[0] + offset, v[1] + offset, v[2] + offset, v[3] + offset, v[4] + offset, v[5], v[6],
+                            v[7], v[8]))
+            f.write(''.join(out))
+
         start_ndx = int(no_mon[r] * nr)
 
     f.close()
@@ -313,48 +351,61 @@ def write_assembly(b, output, no_mon, xlink=False):
 
 def get_indices(a, xlink):
     # find the indices of all fields that need to be modified
-    atoms_index = 0  # find index where [ atoms ] section begins
-    while a[atoms_index].count('[ atoms ]') == 0:
-        atoms_index += 1
-
-    bonds_index = 0  # find index where [ bonds ] section begins
-    while a[bonds_index].count('[ bonds ]') == 0:
-        bonds_index += 1
+    headers = {'atoms_index': '[ atoms ]', 'bonds_index': '[ bonds ]', 'pairs_index': '[ pairs ]',
+               'angles_index': '[ angles ]', 'dihedrals_p_index': '[ dihedrals ] ; propers',
+               'dihedrals_imp_index': '[ dihedrals ] ; impropers', 'vsite_index': '[ virtual_sites'}
 
-    pairs_index = 0  # find index where [ pairs ] section begins
-    while a[pairs_index].count('[ pairs ]') == 0:
-        pairs_index += 1
+    indices = {}  # line where each section begins. Only the first occurrence of each header counts
+    for i, line in enumerate(a):
+        if '[' in line:
+            for section, header in headers.items():
+                if section not in indices and header in line:
+                    indices[section] = i
 
-    angles_index = 0  # find index where [ angles ] section begins
-    while a[angles_index].count('[ angles ]') == 0:
-        angles_index += 1
-
-    dihedrals_p_index = 0  # find index where [ dihedrals ] section begins (propers)
-    while a[dihedrals_p_index].count('[ dihedrals ] ; propers') == 0:
-        dihedrals_p_index += 1
-
-    dihedrals_imp_index = 0  # find index where [ dihedrals ] section begins (impropers)
-    while a[dihedrals_imp_index].count('[ dihedrals ] ; impropers') == 0:
-        dihedrals_imp_index += 1
+    for section in headers:
+        if section != 'vsite_index' and section not in indices:
+            raise IndexError('Could not find the %s section of the topology' % headers[section])
 
     # if xlink == 'on':
     try:
-        vsite_index = 0  # find index where [ dihedrals ] section begins (propers)
-        while a[vsite_index].count('[ virtual_sites') == 0:
-            vsite_index += 1
+        vsite_index = indices['vsite_index']
         vtype = a[vsite_index].split('virtual_sites')[1].split()[0]
         vfunc = a[vsite_index + 1].split()[4]
         if vtype == '3' and vfunc == '2':
             vtype = vtype + 'fd'
-    except IndexError:
+    except (KeyError, IndexError):
         vsite_index = None
         vtype = None
     # else:
     #     vsite_index = 0
 
-    return {'atoms_index': atoms_index, 'bonds_index': bonds_index, 'pairs_index': pairs_index,
-            'angles_index': angles_index, 'dihedrals_p_index': dihedrals_p_index,
-            'dihedrals_imp_index': dihedrals_imp_index, 'vsite_index': vsite_index, 'vtype': vtype}
+    return {'atoms_index': indices['atoms_index'], 'bonds_index': indices['bonds_index'],
+            'pairs_index': indices['pairs_index'], 'angles_index': indices['angles_index'],
+            'dihedrals_p_index': indices['dihedrals_p_index'], 'dihedrals_imp_index': indices['dihedrals_imp_index'],
+            'vsite_index': vsite_index, 'vtype': vtype}
+
+
+def _rotate_z(theta):
+    """ Generate rotation matrices for rotating about the z-axis. Vectorized version of transform.rotate_z
+
+    :param theta: angles by which to rotate
+
+    :type theta: numpy.ndarray
+
+    :return: Rotation matrices, shape (theta.size, 3, 3), to rotate input vectors about z-axis
+    :rtype numpy.ndarray
+    """
+
+    theta = np.asarray(theta, dtype=float).ravel()
+
+    Rz = np.zeros([theta.size, 3, 3])
+    Rz[:, 0, 0] = np.cos(theta)
+    Rz[:, 1, 0] = np.sin(theta)
+    Rz[:, 0, 1] = -np.sin(theta)
+    Rz[:, 1, 1] = np.cos(theta)
+    Rz[:, 2, 2] = 1
+
+    return Rz
 
 
 def write_initial_config(positions, identity, name, no_layers, layer_distribution, dist, no_pores, p2p, no_ions, rot, out,
@@ -370,103 +421,75 @@ def write_initial_config(positions, identity, name, no_layers, layer_distributio
 
     rot *= np.pi / 180  # convert input (degrees) to radians
 
+    no_atoms = positions.shape[1]
+
+    # work with contiguous (natoms, 3) coordinates so each atom's xyz is adjacent in memory
     if flipped:
         flipped = np.asarray(flipped)
-        flipped = np.reshape(flipped, positions.shape)
+        flipped = np.ascontiguousarray(np.reshape(flipped, positions.shape).T)
         flip = 'yes'
-        unflipped = copy.deepcopy(positions)
     else:
         flip = 'no'
 
+    positions = np.ascontiguousarray(positions.T)
+    current = positions  # coordinates of the monomer used in the pore being built
+
     # main monomer
     atom_count = 1
     monomer_count = 0
-    no_atoms = positions.shape[1]
     for l in range(0, no_pores):  # loop to create multiple pores
-        # b = grid[0, l]
-        # c = grid[1, l]
-        theta = 30  # angle which will be used to do hexagonal packing
-        if l == 0:  # unmodified coordinates
-            b = 0
-            c = 0
-        elif l == 1:  # move a pore directly down
-            b = -1
-            c = 0
-            if flip == 'yes':
-                positions[:, :] = flipped
-        elif l == 2:  # moves pore up and to the right
-            b = -math.sin(math.radians(theta))
-            c = -math.cos(math.radians(theta))
-            if flip == 'yes':
-                positions[:, :] = unflipped
-        elif l == 3:  # moves a pore down and to the right
-            b = math.cos(math.radians(90 - theta))
-            c = -math.sin(math.radians(90 - theta))
-            if flip == 'yes':
-                positions[:, :] = flipped
+        b, c = _PORE_OFFSETS[l]
+        if flip == 'yes' and l > 0:  # alternate between flipped and unflipped monomers from pore to pore
+            current = flipped if l % 2 == 1 else positions
         for k in range(no_layers):
             layer_mons = layer_distribution[l*no_layers + k]
-            for j in range(layer_mons):  # iterates over each monomer to create coordinates
+            j = np.arange(layer_mons)  # index of each monomer in the layer
+            theta = j * math.pi / (layer_mons / 2.0) + rot
+            theta += k * math.pi * (offset_angle / 180)
+            if offset:
+                theta += (k % 2) * (math.pi / layer_mons)
+            Rx = _rotate_z(theta)
+            # rotate every monomer in the layer at once, shape (layer_mons, no_atoms - no_ions, 3)
+            xyz = current[:(no_atoms - no_ions), :] @ Rx.transpose(0, 2, 1)
+            if helix:
+                z = k*dist + (dist / float(layer_mons))*j
+            elif k % 2 == 0:
+                z = np.full(layer_mons, k*dist - 0.5*dist)
+            else:
+                z = np.full(layer_mons, k*dist)
+            xyz += np.stack((np.full(layer_mons, b*p2p), np.full(layer_mons, c*p2p), z), axis=1)[:, np.newaxis, :]
+            for m in range(layer_mons):  # iterates over each monomer to write coordinates
                 monomer_count += 1
-                theta = j * math.pi / (layer_mons / 2.0) + rot
-                theta += k * math.pi * (offset_angle / 180)
-                if offset:
-                    theta += (k % 2) * (math.pi / layer_mons)
-                Rx = transform.rotate_z(theta)
-                xyz = np.zeros(positions.shape)
-                for i in range(positions.shape[1] - no_ions):
-                    if helix:
-                        xyz[:, i] = np.dot(Rx, positions[:, i]) + [b*p2p, c*p2p, k*dist + (dist / float(layer_mons))*j]
-                        hundreds = int(math.floor(atom_count / 100000))
-                    else:
-                        if k % 2 == 0:
-                            xyz[:, i] = np.dot(Rx, positions[:, i]) + [b*p2p, c*p2p, k*dist - 0.5*dist]
-                        else:
-                            xyz[:, i] = np.dot(Rx, positions[:, i]) + [b*p2p, c*p2p, k*dist]
-                        # xyz[:, i] = np.dot(Rx, positions[:, i]) + [b, c, k*dist]
-                        hundreds = int(math.floor(atom_count / 100000))
+                for i in range(no_atoms - no_ions):
                     f.write('{:5d}{:5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}'.format(monomer_count, name, identity[i],
-                        atom_count - hundreds*100000, xyz[0, i] / 10.0, xyz[1, i] / 10.0, xyz[2, i] / 10.0) + "\n")
+                        atom_count % 100000, xyz[m, i, 0] / 10.0, xyz[m, i, 1] / 10.0, xyz[m, i, 2] / 10.0) +
+                        "\n")
                     atom_count += 1
 
     # Ions:
 
+    ions = no_atoms - 1 - np.arange(no_ions)  # ions are the last no_ions atoms, written in reverse order
     for l in range(no_pores):  # loop to create multiple pores
-        # b = grid[0, l]
-        # c = grid[1, l]
-        theta = 30  # angle which will be used to do hexagonal packing
-        if l == 0:  # unmodified coordinates
-            b = 0
-            c = 0
-        elif l == 1:  # move a pore directly down
-            b = - 1
-            c = 0
-        elif l == 2:  # moves pore up and to the right
-            b = math.cos(math.radians(90 - theta))
-            c = -math.sin(math.radians(90 - theta))
-        elif l == 3:  # moves a pore down and to the right
-            b = -math.sin(math.radians(theta))
-            c = -math.cos(math.radians(theta))
+        b, c = _ION_PORE_OFFSETS[l]
         for k in range(no_layers):
             layer_mons = layer_distribution[l*no_layers + k]
-            for j in range(layer_mons):  # iterates over each monomer to create coordinates
-                theta = j * math.pi / (layer_mons / 2.0) + rot
-                if offset:
-                    theta += (k % 2) * (math.pi / layer_mons) + rot
-                Rx = transform.rotate_z(theta)
-                xyz = np.zeros([3, no_ions])
+            j = np.arange(layer_mons)  # index of each monomer in the layer
+            theta = j * math.pi / (layer_mons / 2.0) + rot
+            if offset:
+                theta += (k % 2) * (math.pi / layer_mons) + rot
+            Rx = _rotate_z(theta)
+            xyz = current[ions, :] @ Rx.transpose(0, 2, 1)  # shape (layer_mons, no_ions, 3)
+            if helix:
+                z = k*dist + (dist / float(layer_mons))*j
+            else:
+                z = np.full(layer_mons, k*dist)
+            xyz += np.stack((np.full(layer_mons, b*p2p), np.full(layer_mons, c*p2p), z), axis=1)[:, np.newaxis, :]
+            for m in range(layer_mons):  # iterates over each monomer to write coordinates
                 for i in range(0, no_ions):
                     monomer_count += 1
-                    if helix:
-                        xyz[:, i] = np.dot(Rx, positions[:, no_atoms - (i + 1)]) + [b*p2p, c*p2p, k*dist + (dist / float(layer_mons))*j]
-                        hundreds = int(math.floor(atom_count / 100000))
-                    else:
-                        xyz[:, i] = np.dot(Rx, positions[:, no_atoms - (i + 1)]) + [b*p2p, c*p2p, k*dist]
-                        # xyz[:, i] = np.dot(Rx, positions[:, no_atoms - (i + 1)]) + [b, c, k*dist]
-                        hundreds = int(math.floor(atom_count / 100000))
-                    f.write('{:5d}{:5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}'.format(monomer_count, identity[no_atoms - (i + 1)],
-                        identity[no_atoms - (i + 1)], atom_count - hundreds*100000, xyz[0, i] / 10.0, xyz[1, i] / 10.0,
-                        xyz[2, i] / 10.0) + "\n")
+                    f.write('{:5d}{:5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}'.format(monomer_count, identity[ions[i]],
+                        identity[ions[i]], atom_count % 100000, xyz[m, i, 0] / 10.0, xyz[m, i, 1] / 10.0,
+                        xyz[m, i, 2] / 10.0) + "\n")
                     atom_count += 1
 
     f.write('   0.00000   0.00000  0.00000\n')
@@ -479,18 +502,12 @@ def last_frame(trr, gro):
 
     if trr.endswith('.trr') or trr.endswith('.xtc'):
 
-        t = md.load('%s' % trr, top='%s' % gro)
-        last = t.slice(-1)
+        # stream the trajectory so that only one chunk of frames is ever held in memory
+        for chunk in md.iterload('%s' % trr, top='%s' % gro, chunk=1000):
+            last_chunk = chunk
 
-        pos = t.xyz
-
-        # 'last' will hold all gro information
-        res_no = [a.residue.index + 1 for a in t.topology.atoms]
-        res_name = [a.residue.name for a in t.topology.atoms]
-
-
-        last = np.zeros([pos.shape[1], pos.shape[2]])
-        last[:, :] = pos[-1, :, :]
+        last = np.zeros([last_chunk.n_atoms, 3])
+        last[:, :] = last_chunk.xyz[-1, :, :]
 
     else:
         print('Incompatible Filetype')
@@ -532,10 +549,31 @@ def write_gro(t, out, frame=-1):
                                                                                   v[frame, 0, 2], v[frame, 1, 2], v[frame, 2, 0]))
 
 
+def _ndx_group(indices):
+    """ Format atom indices as the body of a gromacs index group, 10 entries per line
+
+    :param indices: 0-based (mdtraj) atom indices
+
+    :type indices: list
+
+    :return: 1-based (gromacs) indices, each left-justified in 8 characters. Every full line of 10 ends in a newline
+    """
+
+    entries = ['{:<8d}'.format(index + 1) for index in indices]  # mdtraj indexes from 0 and gromacs from 1
+    rows = [''.join(entries[i:(i + 10)]) for i in range(0, len(entries), 10)]
+
+    if len(entries) % 10 == 0:
+        return ''.join(row + '\n' for row in rows)
+    else:
+        return ''.join(row + '\n' for row in rows[:-1]) + rows[-1]
+
+
 def write_water_ndx(keep, t):
     """ Generate index groups for waters inside membrane. The indices are the same as those in the fully solvated
     structure """
 
+    keep = set(keep)
+
     waters = []
     membrane = []
     for a in t.topology.atoms:
@@ -544,25 +582,13 @@ def write_water_ndx(keep, t):
         elif a.index in keep:  # otherwise it is part of the membrane. Needs to be in keep though or else the unkept \
             membrane.append(a.index)  # water will go in the membrane list where they aren't supposed to >:(
 
-    count = 1
     with open('water_index.ndx', 'w') as f:  # open up an index file to write to
 
         f.write('[  water  ]\n')  # first index group
-        for index in waters:
-            if count % 10 != 0:  # every 10 entries, make a new line
-                f.write('{:<8s}'.format(str(index + 1)))  # things are indexed starting at 0 in mdtraj and 1 in gromacs
-            else:
-                f.write('{:<8s}\n'.format(str(index + 1)))
-            count += 1
+        f.write(_ndx_group(waters))
 
         f.write('\n[  membrane  ]\n')  # membrane section!
-        count = 1
-        for index in membrane:
-            if count % 10 != 0:
-                f.write('{:<8s}'.format(str(index + 1)))
-            else:
-                f.write('{:<8s}\n'.format(str(index + 1)))
-            count += 1
+        f.write(_ndx_group(membrane))
 
 
 def write_gro_pos(pos, out, name='NA', box=None, ids=None, res=None, vel=None, ucell=None):
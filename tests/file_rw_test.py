@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+
+from LLC_Membranes.llclib import file_rw
+import numpy as np
+import os
+import tempfile
+
+test_system = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_system')
+
+# write_assembly output for one MON monomer (residue 1) followed by two more (residue 2)
+assembly = (
+    '[ moleculetype ]\n'
+    ';name           nrexcl\n'
+    'restrained         3\n'
+    '\n'
+    '[ atoms ]\n'
+    '    1   ca  1  MON  C1            1  -0.099240  12.010000\n'
+    '    2   ca  1  MON  C2            2   0.056123  12.010000\n'
+    '    3   os  1  MON  O1            3  -0.343840  16.000000\n'
+    '    4   ca  1  MON  C1            4  -0.099240  12.010000\n'
+    '    5   ca  1  MON  C2            5   0.056123  12.010000\n'
+    '    6   os  1  MON  O1            6  -0.343840  16.000000\n'
+    '    7   ca  1  MON  C1            7  -0.099240  12.010000\n'
+    '    8   ca  1  MON  C2            8   0.056123  12.010000\n'
+    '    9   os  1  MON  O1            9  -0.343840  16.000000\n'
+    '\n'
+    '[ bonds ]\n'
+    '     1      2 1\n'
+    '     2      3 1\n'
+    '     4      5 1\n'
+    '     5      6 1\n'
+    '     7      8 1\n'
+    '     8      9 1\n'
+    '\n'
+    '[ pairs ]\n'
+    '     1      3    1\n'
+    '     4      6    1\n'
+    '     7      9    1\n'
+    '\n'
+    '[ angles ]\n'
+    '     1      2      3  1\n'
+    '     4      5      6  1\n'
+    '     7      8      9  1\n'
+    '\n'
+    '[ dihedrals ] ; propers\n'
+    '     1      2      3      1      3\n'
+    '     4      5      6      4      3\n'
+    '     7      8      9      7      3\n'
+    '\n'
+    '[ dihedrals ] ; impropers\n'
+    '     3      1      2      1      1\n'
+    '     6      4      5      4      1\n'
+    '     9      7      8      7      1\n'
+    '\n'
+    '\n'
+    '[ virtual_sites4 ]\n'
+    '4     1     2     3     2     0.5000  0.1400  \n'
+    '\n'
+    '[ virtual_sites4 ]\n'
+    '7     4     5     6     2     0.5000  0.1400  \n'
+    '10    7     8     9     2     0.5000  0.1400  \n'
+)
+
+
+class TestFileRW():
+
+    def test_get_indices(self):
+
+        with open('%s/restrained.itp' % test_system, 'r') as f:
+            a = f.readlines()
+
+        indices = file_rw.get_indices(a, False)
+
+        assert indices == {'atoms_index': 6, 'bonds_index': 16449, 'pairs_index': 32892, 'angles_index': 74775,
+                           'dihedrals_p_index': 105018, 'dihedrals_imp_index': 147141, 'vsite_index': None,
+                           'vtype': None}
+
+        assert file_rw._section_length(a, indices['atoms_index'] + 2) == 16440, 'Should be 16440 atoms'
+        assert file_rw._section_length(a, indices['dihedrals_imp_index'] + 1) == 1801, 'Should be 1801 impropers'
+
+    def test_write_assembly(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            file_rw.write_assembly(['MON', 'MON'], '%s/assembly.itp' % tmp, [1, 2], top_location=test_system)
+
+            with open('%s/assembly.itp' % tmp, 'r') as f:
+                assert f.read() == assembly
+
+    def test_write_initial_config(self):
+
+        # 4 monomer atoms followed by 1 ion, in angstroms
+        positions = np.array([[1.5, 4.2, 6.8, 9.1, 12.0],
+                              [0.3, -0.8, 1.1, 0.4, 2.6],
+                              [0.0, 1.2, -0.9, 2.3, 0.7]])
+        identity = ['C', 'C1', 'O', 'O1', 'NA']
+        flipped = list((positions * np.array([[1], [1], [-1]])).ravel())  # reflected through the xy plane
+
+        # name: (no_pores, offset, helix, flipped)
+        configs = {'offset_4pores': (4, True, False, []), 'helix_flipped_4pores': (4, False, True, flipped),
+                   'offset_flipped_3pores': (3, True, False, flipped), 'helix_3pores': (3, False, True, [])}
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)  # write_initial_config also writes test.gro to the working directory
+            try:
+                for name, (no_pores, offset, helix, flip) in configs.items():
+                    out = 'initial_config_%s.gro' % name
+                    file_rw.write_initial_config(positions.copy(), identity, 'HII', 2, [3, 2] * no_pores, 3.7,
+                                                 no_pores, 40., 1, 15., out, offset, helix, 10., *flip)
+
+                    with open(out, 'r') as f, open('%s/%s' % (test_system, out), 'r') as expected:
+                        assert f.read() == expected.read(), '%s differs from the reference' % out
+            finally:
+                os.chdir(cwd)
+
+    def test_ndx_group(self):
+
+        assert file_rw._ndx_group([]) == ''
+        assert file_rw._ndx_group([0, 1, 2]) == '1       2       3       '
+        assert file_rw._ndx_group(list(range(10))) == ''.join('{:<8d}'.format(i) for i in range(1, 11)) + '\n'
+        assert file_rw._ndx_group(list(range(95, 107))) == \
+            ''.join('{:<8d}'.format(i) for i in range(96, 106)) + '\n' + '106     107     '
+
+
+if __name__ == "__main__":
+
+    test = TestFileRW()
+    test.test_get_indices()
+    test.test_write_assembly()
+    test.test_write_initial_config()
+    test.test_ndx_group()